@@ -1,48 +1,224 @@
 import discord
-from discord import app_commands
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from discord.ext import commands
-from pathlib import Path
 import aiohttp
 import re
 import fitz
 import asyncio
-import flask
+import time
+import math
+import operator
+import collections
+import functools
+import datetime
+import hashlib
+import random
+import weakref
+import concurrent.futures
+import urllib.parse as urlparse
+# Web Scraping
+import requests
+from bs4 import BeautifulSoup
+# YouTube API
+from youtube_transcript_api import YouTubeTranscriptApi
+from youtube_transcript_api._errors import TranscriptsDisabled
+# Keep bot running 24/7
+from keep_alive import keep_alive
+import config
+config.configure()
 from config import *
 
 GEMINI_API_KEY = gemini_api_key
 DISCORD_BOT_TOKEN = discord_bot_token
+GEMINI_MODEL = gemini_model
 MAX_HISTORY = max_history
 
 message_history = {}
-tracked_threads = []
+tracked_threads = set()
 
-# Keep bot running 24/7
+# Keywords that reset the message history (case sensitive, so they have to be in all caps)
+clear_history_pattern = re.compile(r'(?:RESET|FORGET|CLEAR|CLEAN) HISTORY')
 
-from keep_alive import keep_alive
-keep_alive()
+# Canned replies from the config, compiled once
+canned_reply_patterns = [(re.compile(r'\s*(?:' + pattern + r')\s*', re.IGNORECASE), reply) for pattern, reply in canned_replies.items()]
 
-# Web Scraping
-import requests
-from bs4 import BeautifulSoup
+# These are the only image extensions it currently accepts
+image_extensions = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.webp'})
 
 #show_debugs = False
 
 # --- Gemini Configs ---
 
 # Configure the generative AI model
+if not GEMINI_API_KEY:
+    raise RuntimeError("GEMINI_API_KEY isn't set, put your Google AI Studio API Key in the .env file (see SETUP.md)")
 genai.configure(api_key=GEMINI_API_KEY)
 
-gemini_model = genai.GenerativeModel(model_name=gemini_model, generation_config=generation_config, safety_settings=safety_settings,system_instruction=system_instruction)
-
-tracked_channels = tracked_channels
+# Thread pool for blocking calls, so they don't freeze the bot
+blocking_pool = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="techiee-io")
+
+async def run_blocking(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(blocking_pool, functools.partial(func, *args, **kwargs))
+
+# Gemini reports rate limits with status code 429
+def is_rate_limit_error(e):
+    return isinstance(e, google_exceptions.GoogleAPICallError) and e.code == 429
+
+# How long Gemini asked to wait before retrying, or None
+def get_retry_after(e):
+    for detail in e.details or ():
+        if isinstance(detail, dict):
+            retry_delay = detail.get('retryDelay')
+            if retry_delay:
+                return float(retry_delay.rstrip('s'))
+        else:
+            retry_delay = getattr(detail, 'retry_delay', None)
+            if retry_delay is not None:
+                return retry_delay.seconds + retry_delay.nanos / 1e9
+    response = getattr(e, 'response', None)
+    retry_after = response.headers.get('Retry-After') if response is not None and hasattr(response, 'headers') else None
+    try:
+        return float(retry_after) if retry_after else None
+    except ValueError:
+        return None
+
+# Retries a Gemini call when it gets rate limited
+async def call_with_retry(func, *args, **kwargs):
+    for attempt in range(max_retries + 1):
+        try:
+            return await func(*args, **kwargs)
+        except google_exceptions.GoogleAPICallError as e:
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+            retry_after = get_retry_after(e)
+            if retry_after is None:
+                delay = random.uniform(0, min(retry_max_delay, retry_base_delay * 2 ** attempt))
+            elif retry_after > retry_max_delay:
+                # Waiting that long would leave the user hanging, so give up right away
+                raise
+            else:
+                # Add some jitter
+                delay = retry_after + random.uniform(0, 0.25)
+            print(f"Rate limited by Gemini, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+context_cache = None
+context_cache_refresh_at = 0
+
+# The system prompt never changes, so it only has to be tokenized once
+@functools.cache
+def system_instruction_tokens():
+    return genai.GenerativeModel(model_name=GEMINI_MODEL).count_tokens(system_instruction).total_tokens
+
+# Caches the system prompt on Google's side if it's long enough
+def create_context_cache():
+    # Too short to cache, no need to count the tokens
+    if context_cache_min_tokens == 0 or len(system_instruction) < context_cache_min_tokens:
+        return None
+    try:
+        token_count = system_instruction_tokens()
+        if token_count < context_cache_min_tokens:
+            return None
+        cache = caching.CachedContent.create(model=GEMINI_MODEL, system_instruction=system_instruction, ttl=datetime.timedelta(seconds=context_cache_ttl))
+        print(f"Cached the system prompt ({token_count} tokens) as {cache.name}")
+        return cache
+    except Exception as e:
+        print(f"Unable to cache the system prompt, using the uncached model instead: {e}")
+        return None
+
+def build_gemini_model():
+    global context_cache, context_cache_refresh_at
+    context_cache = create_context_cache()
+    if context_cache is None:
+        return genai.GenerativeModel(model_name=GEMINI_MODEL, generation_config=generation_config, safety_settings=safety_settings(),system_instruction=system_instruction)
+    context_cache_refresh_at = time.monotonic() + context_cache_ttl / 2
+    return genai.GenerativeModel.from_cached_content(cached_content=context_cache, generation_config=generation_config, safety_settings=safety_settings())
+
+# Keeps the cached system prompt alive
+async def refresh_context_cache():
+    global gemini_model, context_cache_refresh_at
+    if context_cache is None or time.monotonic() < context_cache_refresh_at:
+        return
+    # Move the refresh time forward first, so it only refreshes once
+    context_cache_refresh_at = time.monotonic() + context_cache_ttl / 2
+    try:
+        await run_blocking(context_cache.update, ttl=datetime.timedelta(seconds=context_cache_ttl))
+    except Exception as e:
+        print(f"Unable to refresh the cached system prompt, recreating it: {e}")
+        gemini_model = await run_blocking(build_gemini_model)
+
+# Built in TechieeBot.setup_hook
+gemini_model = None
+
+# --- HTTP Session ---
+
+# Shared session for downloading attachments
+http_session = None
+
+async def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        # Attachments all come from the same CDN host
+        connector = aiohttp.TCPConnector(limit=64, limit_per_host=16, ttl_dns_cache=600, keepalive_timeout=75, enable_cleanup_closed=True)
+        http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60, sock_connect=10))
+    return http_session
+
+# Limits how many attachments get downloaded at the same time, created inside the running loop
+download_semaphore = None
+
+def get_download_semaphore():
+    global download_semaphore
+    if download_semaphore is None:
+        download_semaphore = asyncio.Semaphore(8)
+    return download_semaphore
+
+# How long a single download can take
+download_timeout = aiohttp.ClientTimeout(total=30)
+
+# Downloads an attachment and returns its bytes
+async def download_attachment(attachment):
+    async with get_download_semaphore():
+        session = await get_http_session()
+        async with session.get(attachment.url, timeout=download_timeout) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+# Downloads all the attachments at the same time, cancels the rest if one fails
+async def download_attachments(attachments):
+    tasks = [asyncio.ensure_future(download_attachment(attachment)) for attachment in attachments]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Wait for the cancelled downloads to finish
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
 
 # --- Discord Code ---
 
+class TechieeBot(commands.Bot):
+    async def setup_hook(self):
+        global gemini_model
+        # Creating the context cache calls the Gemini API, so it's done on the thread pool
+        gemini_model = await run_blocking(build_gemini_model)
+        # Start the webserver that keeps the bot running 24/7
+        await keep_alive()
+
+    async def close(self):
+        await super().close()
+        await close_http_session()
+
 # Initialize Discord bot
 defaultIntents = discord.Intents.all()
 defaultIntents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=defaultIntents,help_command=None,activity = discord.Activity(type=discord.ActivityType.listening, name="your every command and being the best Discord chatbot!"))
+bot = TechieeBot(command_prefix="!", intents=defaultIntents,help_command=None,activity = discord.Activity(type=discord.ActivityType.listening, name="your every command and being the best Discord chatbot!"))
 
 @bot.event
 async def on_ready():
@@ -66,34 +242,42 @@ async def process_message(message):
             # Check for image attachments
             if message.attachments:
                 # Currently no chat history for images
-                for attachment in message.attachments:
+                image_attachments = [attachment for attachment in message.attachments if is_image_attachment(attachment)]
+                if image_attachments:
                     print(f"New Image Message FROM: {message.author.name} : {cleaned_text}")
-                    # these are the only image extensions it currently accepts
-                    if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']):
-                        print("Processing Image")
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(attachment.url) as resp:
-                                if resp.status != 200:
-                                    await message.channel.send('❌ Unable to download the image.')
-                                    return
-                                image_data = await resp.read()
-                                response_text = await generate_response_with_image_and_text(image_data, cleaned_text)
-                                await split_and_send_messages(message, response_text, 1900)
-                                return
-                    else:
-                        print(f"New Text Message FROM: {message.author.name} : {cleaned_text}")
-                        await ProcessAttachments(message, cleaned_text)
+                    print(f"Processing {len(image_attachments)} Image(s)")
+                    # The limit is for all the images together
+                    if sum(attachment.size for attachment in image_attachments) > max_attachment_size:
+                        await message.channel.send('❌ The images are too big.')
+                        return
+                    # Download all the images at the same time
+                    try:
+                        image_data = await download_attachments(image_attachments)
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        await message.channel.send('❌ Unable to download the image.')
                         return
+                    response_text = await generate_response_with_images_and_text(image_data, cleaned_text)
+                    await split_and_send_messages(message, response_text, 1900)
+                    return
+                else:
+                    print(f"New Text Message FROM: {message.author.name} : {cleaned_text}")
+                    await ProcessAttachments(message, cleaned_text)
+                    return
             # Not an Image, check for text responses
             else:
                 print(f"New Message Message FROM: {message.author.name} : {cleaned_text}")
                 # Check for keywords to reset history
-                if "RESET HISTORY" in cleaned_text or "FORGET HISTORY" in cleaned_text or "CLEAR HISTORY" in cleaned_text or "CLEAN HISTORY" in cleaned_text:
-                    # End back message
-                    if message.author.id in message_history:
-                        del message_history[message.author.id]
+                if clear_history_pattern.search(cleaned_text):
+                    # End back message, after the response that's being generated
+                    async with get_history_lock(message.author.id):
+                        clear_message_history(message.author.id)
                     await message.channel.send("🧼 History Reset for user: " + str(message.author.name))
                     return
+                # Check for canned replies, these don't need Gemini at all
+                canned_reply = get_canned_reply(cleaned_text)
+                if canned_reply is not None:
+                    await split_and_send_messages(message, canned_reply, 1900)
+                    return
                 # Check for URLs
                 if extract_url(cleaned_text) is not None:
                     print(f"Got URL: {extract_url(cleaned_text)}")
@@ -102,56 +286,154 @@ async def process_message(message):
                     return
                 # Check if history is disabled, if so, send response
                 if MAX_HISTORY == 0:
-                    response_text = await generate_response_with_text(cleaned_text)
-                    # Add AI response to history
+                    response_text = await generate_response_with_semantic_cache(cleaned_text)
                     await split_and_send_messages(message, response_text, 1900)
                     return
-                # Add user's question to history
-                update_message_history(message.author.id, cleaned_text)
-                response_text = await generate_response_with_text(get_formatted_message_history(message.author.id))
-                # Add AI response to history
-                update_message_history(message.author.id, response_text)
-                # Split the Message so discord does not get upset
-                await split_and_send_messages(message, response_text, 1900)
+                # Answer one message per user at a time
+                async with get_history_lock(message.author.id):
+                    # New conversations can use the semantic cache
+                    if message.author.id not in message_history:
+                        response_text = await generate_response_with_semantic_cache(cleaned_text)
+                        await split_and_send_messages(message, response_text, 1900)
+                        # Errors aren't part of the conversation
+                        if response_text.startswith("❌"):
+                            return
+                    else:
+                        # Stream the response
+                        prompt = get_formatted_message_history(message.author.id) + '\n\n' + cleaned_text
+                        try:
+                            response_text = await stream_and_send_messages(message, generate_response_stream(prompt), 1900)
+                        except Exception as e:
+                            # Report the error on its own
+                            await message.channel.send(format_exception(e))
+                            return
+                    # Add the question and the response to history
+                    update_message_history(message.author.id, cleaned_text)
+                    update_message_history(message.author.id, response_text)
 
 
 # --- Message History ---
      
 # AI Generation History         
 
+# Logs a failed Gemini call and formats it the same way for every kind of message
+def format_exception(e):
+    print(f"Gemini call failed: {e!r}")
+    return f"❌ Exception: {e}"
+
+# Prompts that are currently being answered, identical prompts share one Gemini call
+pending_text_responses = {}
+
 async def generate_response_with_text(message_text):
+    task = pending_text_responses.get(message_text)
+    if task is None:
+        task = asyncio.ensure_future(request_response_with_text(message_text))
+        pending_text_responses[message_text] = task
+        task.add_done_callback(lambda _: pending_text_responses.pop(message_text, None))
+    # Shielded so one cancelled message doesn't cancel it for the others
+    return await asyncio.shield(task)
+
+async def request_response_with_text(message_text):
     try:
+        await refresh_context_cache()
         prompt_parts = [message_text]
-        response = gemini_model.generate_content(prompt_parts)
+        response = await call_with_retry(gemini_model.generate_content_async, prompt_parts)
         if response._error:
-            return "❌" + str(response._error)
+            return f"❌{response._error}"
         return response.text
     except Exception as e:
-        return "❌ Exception: " + str(e)
+        return format_exception(e)
+
+# Yields the response text as Gemini generates it
+async def generate_response_stream(message_text):
+    await refresh_context_cache()
+    prompt_parts = [message_text]
+    response = await call_with_retry(gemini_model.generate_content_async, prompt_parts, stream=True)
+    async for chunk in response:
+        yield chunk.text
 
-async def generate_response_with_image_and_text(image_data, text):
+async def generate_response_with_images_and_text(images, text):
     try:
-        image_parts = [{"mime_type": "image/jpeg", "data": image_data}]
-        prompt_parts = [image_parts[0], f"\n{text if text else default_image_prompt}"]
-        response = gemini_model.generate_content(prompt_parts)
+        await refresh_context_cache()
+        image_parts = [{"mime_type": "image/jpeg", "data": image_data} for image_data in images]
+        prompt_parts = [*image_parts, f"\n{text if text else default_image_prompt}"]
+        response = await call_with_retry(gemini_model.generate_content_async, prompt_parts)
         if response._error:
-            return "❌" + str(response._error)
+            return f"❌{response._error}"
         return response.text
     except Exception as e:
-        return "❌ Exception: " + str(e)
+        return format_exception(e)
             
+# --- Semantic Response Cache ---
+
+# Maps each cached prompt to its normalized embedding and the response
+semantic_cache = collections.OrderedDict()
+
+async def embed_text(text):
+    result = await genai.embed_content_async(model=embedding_model, content=text)
+    embedding = result['embedding']
+    norm = math.sqrt(sum(value * value for value in embedding))
+    return [value / norm for value in embedding] if norm else embedding
+
+# Answers from the semantic cache if a similar message was already answered
+async def generate_response_with_semantic_cache(message_text):
+    if semantic_cache_size == 0:
+        return await generate_response_with_text(message_text)
+    try:
+        embedding = await embed_text(message_text)
+    except Exception as e:
+        print(f"Unable to embed message for the semantic cache: {e}")
+        return await generate_response_with_text(message_text)
+
+    # Compare on the thread pool, with a copy of the cache
+    best_prompt, best_similarity = await run_blocking(find_most_similar_prompt, embedding, list(semantic_cache.items()))
+    cached = semantic_cache.get(best_prompt)
+    if cached is not None and best_similarity >= semantic_cache_threshold:
+        print(f"Semantic cache hit ({best_similarity:.2f}): {best_prompt}")
+        semantic_cache.move_to_end(best_prompt)
+        return cached[1]
+
+    response_text = await generate_response_with_text(message_text)
+    # Don't cache errors
+    if not response_text.startswith("❌"):
+        semantic_cache[message_text] = (embedding, response_text)
+        if len(semantic_cache) > semantic_cache_size:
+            semantic_cache.popitem(last=False)
+    return response_text
+
+# Returns the cached prompt most similar to the embedding and how similar it is
+def find_most_similar_prompt(embedding, cached_items):
+    # The embeddings are normalized, so the dot product is the cosine similarity
+    best_prompt = None
+    best_similarity = 0
+    for prompt, (cached_embedding, _) in cached_items:
+        similarity = sum(map(operator.mul, embedding, cached_embedding))
+        if similarity > best_similarity:
+            best_prompt = prompt
+            best_similarity = similarity
+    return best_prompt, best_similarity
+
 # User message History
+# One lock per user
+history_locks = weakref.WeakValueDictionary()
+
+def get_history_lock(user_id):
+    lock = history_locks.get(user_id)
+    if lock is None:
+        lock = history_locks[user_id] = asyncio.Lock()
+    return lock
+
+# No lock needed, this never awaits
 def update_message_history(user_id, text):
-    # Check if user_id already exists in the dictionary
-    if user_id in message_history:
-        # Append the new message to the user's message list
-        message_history[user_id].append(text)
-        # If there are more than 12 messages, remove the oldest one
-        if len(message_history[user_id]) > MAX_HISTORY:
-            message_history[user_id].pop(0)
-    else:
-        # If the user_id does not exist, create a new entry with the message
-        message_history[user_id] = [text]
+    history = message_history.get(user_id)
+    # If the user_id does not exist, create a new entry for it
+    if history is None:
+        history = message_history[user_id] = collections.deque(maxlen=MAX_HISTORY)
+    # Append the new message to the user's message history
+    history.append(text)
+
+def clear_message_history(user_id):
+    message_history.pop(user_id, None)
         
 def get_formatted_message_history(user_id):
     """
@@ -165,66 +447,140 @@ def get_formatted_message_history(user_id):
     
 # --- Sending Messages ---
 async def split_and_send_messages(message_system, text, max_length):
-    # Split the string into parts
-    messages = []
-    for i in range(0, len(text), max_length):
-        sub_message = text[i:i+max_length]
-        messages.append(sub_message)
-
     # Send each part as a separate message
-    for string in messages:
+    for string in split_message(text, max_length):
         await message_system.channel.send(string)    
 
+# Splits the string into parts of at most max_length characters, one part at a time
+def split_message(text, max_length):
+    start = 0
+    while start < len(text):
+        end = find_split_point(text, start, max_length)
+        # Discord doesn't accept empty messages, or ones that are only whitespace
+        if not text[start:end].isspace():
+            yield text[start:end]
+        start = end
+
+# How often (in seconds) a streamed message gets edited
+stream_edit_interval = 1
+
+# Sends a response while it's being generated, returns the whole response
+async def stream_and_send_messages(message_system, text_stream, max_length):
+    text = ""
+    # The message being filled, where its text starts, and what it shows
+    current_message = None
+    current_start = 0
+    current_content = None
+    last_update = 0
+    async for chunk in text_stream:
+        text += chunk
+        # Once the current message is full, finish it and start a new one
+        while len(text) - current_start > max_length:
+            end = find_split_point(text, current_start, max_length)
+            await send_or_edit_message(message_system, current_message, text[current_start:end])
+            current_start = end
+            current_message = None
+            current_content = None
+        if time.monotonic() - last_update >= stream_edit_interval and len(text) > current_start:
+            current_content = text[current_start:]
+            current_message = await send_or_edit_message(message_system, current_message, current_content)
+            last_update = time.monotonic()
+    # Show whatever came in after the last edit
+    if len(text) > current_start and text[current_start:] != current_content:
+        await send_or_edit_message(message_system, current_message, text[current_start:])
+    return text
+
+# Returns where to split the message that starts at start, preferring line breaks and spaces
+def find_split_point(text, start, max_length):
+    end = start + max_length
+    if end >= len(text):
+        return len(text)
+    # Only use a line break past the middle
+    cut = text.rfind('\n', start, end)
+    if cut >= start + max_length // 2:
+        return cut + 1
+    cut = text.rfind(' ', start, end)
+    if cut > start:
+        return cut + 1
+    return end
+
+async def send_or_edit_message(message_system, sent_message, text):
+    # Discord doesn't accept empty messages, or ones that are only whitespace
+    if not text or text.isspace():
+        return sent_message
+    if sent_message is None:
+        return await message_system.channel.send(text)
+    await sent_message.edit(content=text)
+    return sent_message
+
+# Checks if the attachment is an image Techiee accepts
+def is_image_attachment(attachment):
+    # Discord filenames never contain path separators, so splitting on the last dot is enough
+    _, dot, extension = attachment.filename.rpartition('.')
+    return bool(dot) and '.' + extension.lower() in image_extensions
+
+# Regular expression pattern to match text between < and >, compiled once
+bracket_pattern = re.compile(r'<[^>]+>')
+
 # Cleans the Discord message of any <@!123456789> tags
 def clean_discord_message(input_string):
-    # Create a regular expression pattern to match text between < and >
-    bracket_pattern = re.compile(r'<[^>]+>')
     # Replace text between brackets with an empty string
     cleaned_content = bracket_pattern.sub('', input_string)
     return cleaned_content  
 
+# Returns the canned reply for the message, or None if there isn't one
+def get_canned_reply(text):
+    for pattern, reply in canned_reply_patterns:
+        if pattern.fullmatch(text):
+            return reply
+    return None
+
 # --- Scraping Text from URL ---
 
 async def ProcessURL(message_str):
     pre_prompt = remove_url(message_str)
     if pre_prompt == "":
         pre_prompt = default_url_prompt   
-    if is_youtube_url(extract_url(message_str)):
+    url = extract_url(message_str)
+    if is_youtube_url(url):
         print("Processing YouTube Transcript")   
-        return await generate_response_with_text(pre_prompt + " " + get_FromVideoID(get_video_id(extract_url(message_str))))     
-    if extract_url(message_str):       
+        transcript = await run_blocking(get_FromVideoID, get_video_id(url))
+        return await generate_response_with_text(pre_prompt + " " + transcript)     
+    if url:       
         print("Processing Standards Link")       
-        return await generate_response_with_text(pre_prompt + " " + extract_text_from_url(extract_url(message_str)))
+        page_text = await run_blocking(extract_text_from_url, url)
+        return await generate_response_with_text(pre_prompt + " " + page_text)
     else:
         return "No URL Found"
     
+# URL patterns, compiled once
+url_pattern = re.compile(
+    r'(?:(?:https?|ftp):\/\/)?'  # http:// or https:// or ftp://
+    r'(?:\S+(?::\S*)?@)?'  # user and password
+    r'(?:'
+    r'(?!(?:10|127)(?:\.\d{1,3}){3})'
+    r'(?!(?:169\.254|192\.168)(?:\.\d{1,3}){2})'
+    r'(?!172\.(?:1[6-9]|2\d|3[0-1])(?:\.\d{1,3}){2})'
+    r'(?:[1-9]\d?|1\d\d|2[01]\d|22[0-3])'
+    r'(?:\.(?:1?\d{1,2}|2[0-4]\d|25[0-5])){2}'
+    r'(?:\.(?:[1-9]\d?|1\d\d|2[0-4]\d|25[0-4]))'
+    r'|'
+    r'(?:www.)?'  # www.
+    r'(?:[a-z\u00a1-\uffff0-9]-?)*[a-z\u00a1-\uffff0-9]+'
+    r'(?:\.(?:[a-z\u00a1-\uffff]{2,}))+'
+    r'(?:\.(?:[a-z\u00a1-\uffff]{2,})+)*'
+    r')'
+    r'(?::\d{2,5})?'  # port
+    r'(?:[/?#]\S*)?',  # resource path
+    re.IGNORECASE
+)
+http_url_pattern = re.compile(r"https?://\S+")
+
 def extract_url(string):
-    url_regex = re.compile(
-        r'(?:(?:https?|ftp):\/\/)?'  # http:// or https:// or ftp://
-        r'(?:\S+(?::\S*)?@)?'  # user and password
-        r'(?:'
-        r'(?!(?:10|127)(?:\.\d{1,3}){3})'
-        r'(?!(?:169\.254|192\.168)(?:\.\d{1,3}){2})'
-        r'(?!172\.(?:1[6-9]|2\d|3[0-1])(?:\.\d{1,3}){2})'
-        r'(?:[1-9]\d?|1\d\d|2[01]\d|22[0-3])'
-        r'(?:\.(?:1?\d{1,2}|2[0-4]\d|25[0-5])){2}'
-        r'(?:\.(?:[1-9]\d?|1\d\d|2[0-4]\d|25[0-4]))'
-        r'|'
-        r'(?:www.)?'  # www.
-        r'(?:[a-z\u00a1-\uffff0-9]-?)*[a-z\u00a1-\uffff0-9]+'
-        r'(?:\.(?:[a-z\u00a1-\uffff]{2,}))+'
-        r'(?:\.(?:[a-z\u00a1-\uffff]{2,})+)*'
-        r')'
-        r'(?::\d{2,5})?'  # port
-        r'(?:[/?#]\S*)?',  # resource path
-        re.IGNORECASE
-    )
-    match = re.search(url_regex, string)
-    return match.group(0) if match else None
+    return match.group(0) if (match := url_pattern.search(string)) else None
 
 def remove_url(text):
-  url_regex = re.compile(r"https?://\S+")
-  return url_regex.sub("", text)
+  return http_url_pattern.sub("", text)
 
 def extract_text_from_url(url):
     # Request the webpage content
@@ -232,7 +588,8 @@ def extract_text_from_url(url):
                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
                    "Accept-Language": "en-US,en;q=0.5"}
     try:
-        response = requests.get(url, headers=headers)
+        # Connect and read timeouts, so a slow site can't hold a thread pool worker forever
+        response = requests.get(url, headers=headers, timeout=(5, 15))
         if response.status_code != 200:
             return "Failed to retrieve the webpage"
 
@@ -251,40 +608,25 @@ def extract_text_from_url(url):
     
 # --- YouTube API ---
 
-from youtube_transcript_api import YouTubeTranscriptApi
-from youtube_transcript_api._errors import TranscriptsDisabled
-import urllib.parse as urlparse
+# Cache transcripts
+@functools.lru_cache(maxsize=64)
+def fetch_transcript(video_id):
+    transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
 
-def get_transcript_from_url(url):
-    try:
-        # Parse the URL
-        parsed_url = urlparse.urlparse(url)
-        
-        # Extract the video ID from the 'v' query parameter
-        video_id = urlparse.parse_qs(parsed_url.query)['v'][0]
-        
-        # Get the transcript
-        transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
-        
-        # Concatenate the transcript
-        transcript = ' '.join([i['text'] for i in transcript_list])
-        
-        return transcript
-    except (KeyError, TranscriptsDisabled):
-        return "Error retrieving transcript from YouTube URL"
+    # Concatenate the transcript
+    return ' '.join([i['text'] for i in transcript_list])
+
+# Regular expression to match YouTube URLs
+youtube_url_pattern = re.compile(
+    r'(https?://)?(www\.)?'
+    r'(youtube|youtu|youtube-nocookie)\.(com|be)/'
+    r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
+)
 
 def is_youtube_url(url):
-    # Regular expression to match YouTube URL
     if url == None:
         return False
-    youtube_regex = (
-        r'(https?://)?(www\.)?'
-        '(youtube|youtu|youtube-nocookie)\.(com|be)/'
-        '(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
-    )
-
-    youtube_regex_match = re.match(youtube_regex, url)
-    return youtube_regex_match is not None  # return True if match, False otherwise
+    return youtube_url_pattern.match(url) is not None  # return True if match, False otherwise
 
 def get_video_id(url):
     # parse the URL
@@ -305,12 +647,7 @@ def get_video_id(url):
 
 def get_FromVideoID(video_id):
     try:
-        transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
-        
-        # concatenate the transcript
-        transcript = ' '.join([i['text'] for i in transcript_list])
-        
-        return transcript
+        return fetch_transcript(video_id)
     except (KeyError, TranscriptsDisabled):
         return "❗️ Error retrieving transcript from YouTube URL"
     
@@ -320,40 +657,67 @@ def get_FromVideoID(video_id):
 async def ProcessAttachments(message,prompt):
     if prompt == "":
         prompt = default_pdf_and_txt_prompt  
-    for attachment in message.attachments:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(attachment.url) as resp:
-                if resp.status != 200:
-                    await message.channel.send('❌ Unable to download the attachment.')
-                    return
-                if attachment.filename.lower().endswith('.pdf'):
-                    print("Processing PDF")
-                    try:
-                        pdf_data = await resp.read()
-                        response_text = await process_pdf(pdf_data,prompt)
-                    except Exception as e:
-                        await message.channel.send('❌ Cannot process attachment.')
-                        return
-                else:
-                    try:
-                        text_data = await resp.text()
-                        response_text = await generate_response_with_text(prompt+ ": " + text_data)
-                    except Exception as e:
-                        await message.channel.send('❌ Cannot process attachment.')
-                        return
+    attachments = message.attachments
+    # The limit is for all the attachments together
+    if sum(attachment.size for attachment in attachments) > max_attachment_size:
+        await message.channel.send('❌ The attachments are too big.')
+        return
+    try:
+        # Download all the attachments at the same time
+        attachment_data = await download_attachments(attachments)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        await message.channel.send('❌ Unable to download the attachment.')
+        return
+    try:
+        # Get the text out of all the attachments at the same time
+        # Let every extraction finish, then raise the first failure
+        texts = await asyncio.gather(*(get_attachment_text(attachment, data) for attachment, data in zip(attachments, attachment_data)), return_exceptions=True)
+        for text in texts:
+            if isinstance(text, BaseException):
+                raise text
+    except Exception as e:
+        await message.channel.send('❌ Cannot process attachment.')
+        return
 
-                await split_and_send_messages(message, response_text, 1900)
-                return
-            
+    if len(texts) == 1:
+        attachment_text = texts[0]
+    else:
+        attachment_text = '\n\n'.join(f"{attachment.filename}:\n{text}" for attachment, text in zip(attachments, texts))
+    response_text = await generate_response_with_text(prompt+ ": " + attachment_text)
+    await split_and_send_messages(message, response_text, 1900)
+
+async def get_attachment_text(attachment, attachment_data):
+    if attachment.filename.lower().endswith('.pdf'):
+        print("Processing PDF")
+        return await get_pdf_text(attachment_data)
+    # Strict, so binary files raise an error
+    return attachment_data.decode('utf-8')
+
+# Text extracted from PDFs, keyed by a hash of the PDF
+pdf_text_cache = collections.OrderedDict()
+pdf_text_cache_size = 64
+
+async def get_pdf_text(pdf_data):
+    # Hash on the thread pool
+    pdf_hash = (await run_blocking(hashlib.blake2b, pdf_data, digest_size=16)).digest()
+    text = pdf_text_cache.get(pdf_hash)
+    if text is None:
+        text = await run_blocking(extract_text_from_pdf, pdf_data)
+        pdf_text_cache[pdf_hash] = text
+        if len(pdf_text_cache) > pdf_text_cache_size:
+            pdf_text_cache.popitem(last=False)
+    else:
+        pdf_text_cache.move_to_end(pdf_hash)
+    print(text)
+    return text
 
-async def process_pdf(pdf_data,prompt):
+def extract_text_from_pdf(pdf_data):
     pdf_document = fitz.open(stream=pdf_data, filetype="pdf")
     text = ""
     for page in pdf_document:
         text += page.get_text()
     pdf_document.close()
-    print(text)
-    return await generate_response_with_text(prompt+ ": " + text)
+    return text
 
 # --- Commands ---
 
@@ -363,7 +727,7 @@ async def process_pdf(pdf_data,prompt):
 async def create_thread(interaction:discord.Interaction,name:str):
 	try:
 		thread = await interaction.channel.create_thread(name=name,auto_archive_duration=60)
-		tracked_threads.append(thread.id)
+		tracked_threads.add(thread.id)
 		await interaction.response.send_message(f"Thread '{name}' created! Go to <#{thread.id}> to join the thread and chat with me there.")
 	except Exception as e:
 		await interaction.response.send_message("❗️ Error creating thread!")
@@ -1,35 +1,83 @@
 # Dependencies
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
+import io
 import os
-from dotenv import load_dotenv
-load_dotenv()
-
-# Environment variables
-gemini_api_key = os.getenv('GEMINI_API_KEY')
-discord_bot_token = os.getenv('DISCORD_BOT_TOKEN')
+import functools
+from pathlib import Path
+from types import MappingProxyType
+from dotenv import dotenv_values
+
+# Environment variables, these get filled in by configure()
+gemini_api_key = None
+discord_bot_token = None
+
+# Read-only snapshot of all the environment variables (including the ones from the .env file), also filled in by configure()
+env = MappingProxyType({})
+
+# Loads the .env files and fills in the environment variables above. This is called once by Techiee.py on startup, so the .env files aren't parsed again every time config gets imported (worker processes inherit the variables through os.environ anyway)
+@functools.cache
+def configure(dotenv_path=None):
+    global env, gemini_api_key, discord_bot_token
+    # Read .env and .env.development (if they exist) and parse them together in one go, the values in .env.development take priority
+    if dotenv_path is None:
+        dotenv_paths = (Path(__file__).parent / '.env', Path(__file__).parent / '.env.development')
+    else:
+        dotenv_paths = (Path(dotenv_path),)
+    dotenv_text = ''
+    for path in dotenv_paths:
+        try:
+            dotenv_text += path.read_text(encoding='utf-8') + '\n'
+        except FileNotFoundError:
+            pass
+    # Variables that are already set in the environment take priority over the .env files
+    for key, value in dotenv_values(stream=io.StringIO(dotenv_text)).items():
+        if value is not None:
+            os.environ.setdefault(key, value)
+    env = MappingProxyType(dict(os.environ))
+    gemini_api_key = env.get('GEMINI_API_KEY')
+    discord_bot_token = env.get('DISCORD_BOT_TOKEN')
 
 # Name of the Gemini model. See https://ai.google.dev/gemini-api/docs/models/gemini#model-variations for more info on the variants.
 # Warning: gemini-exp-1121 is an experimental model. If you don't want the experimental model, use "gemini-1.5-pro" or any other model of your choice instead.
 gemini_model = "gemini-1.5-pro"
 
 # AI generation configs, these are some pretty advanced settings, don't mess around with these if you don't know what you're doing
-generation_config = {
+# It's read-only, so it can be shared between every request without being copied
+generation_config = MappingProxyType({
     "temperature": 1,
     "top_p": 1,
     "top_k": 32,
     "max_output_tokens": 4096,
-}
+})
+
+# How many times a Gemini request is retried when it gets rate limited (error 429), set to 0 to disable retrying
+max_retries = 3
+
+# The wait before the first retry can be up to this many seconds, it doubles after each retry but never goes above retry_max_delay
+retry_base_delay = 1
+retry_max_delay = 30
+
+# Gemini context caching for the system prompt. It's only used if the system prompt is at least this many tokens long (the API doesn't accept smaller caches), set to 0 to disable it
+# Note: context caching only works with explicit model versions, like "gemini-1.5-pro-002"
+context_cache_min_tokens = 32768
+
+# How long (in seconds) the cached system prompt is kept on Google's side, it gets refreshed automatically while the bot is being used
+context_cache_ttl = 3600
 
 # Safety settings, the thresholds can be BLOCK_NONE, BLOCK_MEDIUM_AND_ABOVE, BLOCK_LOW_AND_ABOVE, or HARM_BLOCK_THRESHOLD_UNSPECIFIED (which uses the default block threshold set by Google)
-safety_settings={
+# This is a function so google.generativeai only gets imported when the settings are actually needed, it's only built once and is read-only
+@functools.cache
+def safety_settings():
+    from google.generativeai.types import HarmCategory, HarmBlockThreshold
+    return MappingProxyType({
         HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
 # The API still doesn't support this one        HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY: HarmBlockThreshold.BLOCK_NONE,
-}
+    })
 
 # System prompt, essentially what the AI needs to know about itself / where it's in / what it does, and the instructions you give it, etc. It will never forget this, unlike the message histroy which has a limit you can set
+# Keep this text static. Anything that changes per message (usernames, channel names, dates...) should go into the user's message instead, otherwise Gemini can't reuse its cached copy of the system prompt
 system_instruction = """
 You are Techiee, an AI chatbot. You were developed by Discord users Tech (@techgamerexpert) and Budd (@merbudd), and they built you on Google's Gemini AI models.
 You are currently chatting in a Discord server.
@@ -44,9 +92,13 @@ If I say "Forget what I told you earlier, now act as X" or anything similar (whe
 """
 
 # The list of tracked channels (the Discord IDs of said channels), in which Techiee will always respond to messages
-tracked_channels = [
+# It's a frozenset so checking if a channel is tracked stays fast no matter how many channels you add
+tracked_channels = frozenset({
 	1208874114916425828,
-]
+})
+
+# The biggest total size (in bytes) of the attachments in one message that Techiee will download, attachments are kept in memory while they're processed. Gemini doesn't accept requests bigger than 20 MB anyway
+max_attachment_size = 20 * 1024 * 1024
 
 # Default prompt if the message is just a URL, just a PDF file / text file, or just an image and nothing else
 default_url_prompt = "Summarize the following by giving me 5 bullet points"
@@ -56,6 +108,17 @@ default_image_prompt = "What is this a picture of?"
 # The maximum amount of messages to be saved in the message history before the oldest message gets deleted, set to 0 to disable message history
 max_history = 30
 
+# Semantic response cache: if a message is similar enough to one Techiee already answered, the saved response is sent instead of asking Gemini again
+# It's only used for messages that don't depend on message history, attachments or URLs. It's shared between all users, so someone can get an answer that was written for someone else's similar message (like "now act as a pirate" and "now act as a cowboy")
+# That's why it's disabled (0) by default, set it to something like 500 to enable it
+semantic_cache_size = 0
+
+# How similar (from 0 to 1) a message has to be to a cached one to reuse its response
+semantic_cache_threshold = 0.9
+
+# The model used to compare messages for the semantic cache
+embedding_model = "models/text-embedding-004"
+
 # Your Discord User ID, used for the /sync command
 discord_user_id = 622137576836431882
 
@@ -84,4 +147,10 @@ Hello, I'm Techiee! An experimental chatbot, right on Discord. I was made by two
 
 -# *Note:* I'm still under development, so I might not always get things right. 
 -# *Note 2:* There currently isn't chat history support for images.
-"""
\ No newline at end of file
+"""
+
+# Canned replies, if a whole message matches one of these patterns (case insensitive), Techiee sends the reply right away instead of asking Gemini
+canned_replies = {
+    r'/?help': help_text,
+    r'who (made|built|developed|created) you\??': "I was made by two Discord users, Tech (@techgamerexpert) and Budd (@merbudd). They built me on Google's Gemini models!",
+}
@@ -1,16 +1,13 @@
-import flask
-from flask import Flask,render_template
-from threading import Thread
-
-app = Flask(__name__)
-
-@app.route('/')
-def index():
-    return "Webserver is on, bot should be alive and 24/7 should work."
-
-def run():
-  app.run(host='0.0.0.0',port=8080)
-
-def keep_alive():  
-    t = Thread(target=run)
-    t.start()
+from aiohttp import web
+
+async def index(request):
+    return web.Response(text="Webserver is on, bot should be alive and 24/7 should work.")
+
+# Runs the webserver inside the bot's event loop, so it doesn't need its own thread
+async def keep_alive():
+    app = web.Application()
+    app.router.add_get('/', index)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host='0.0.0.0', port=8080)
+    await site.start()